@@ -6,17 +6,21 @@ A cli to destructively test attached disks, using the same patterns as badblocks
 Unlike badblocks though, this reads and writes to the chosen disks in parallel.
 """
 
+import ctypes
+import errno
+import fcntl
 import mmap
 import os
+import struct
 from stat import S_ISLNK
 import subprocess
 import argparse
 import pathlib
 import sys
-import time
-import rapidjson
+import json
+import queue
 from datetime import datetime
-from multiprocessing import Pool, Array
+from multiprocessing import get_context, shared_memory
 
 # Rich
 from rich import print
@@ -31,16 +35,84 @@ from rich.table import Table
 from prompt_toolkit import prompt
 from prompt_toolkit.key_binding import KeyBindings
 
+# liburing is optional.  Without it we fall back to plain pread/pwrite calls
+try:
+    import liburing
+except ImportError:
+    liburing = None
+
+BLKGETSIZE64 = 0x80081272  # _IOR(0x12, 114, size_t)
+BLKSSZGET = 0x1268  # _IO(0x12, 104)
+BLOCK_STAMP = struct.Struct(
+    "<Q"
+)  # The byte offset written at the start of each block of random data
+CACHE_LINE_SIZE = 64
 CMD_LSBLK = "/usr/bin/lsblk"
 CMD_ZFS = "/usr/bin/zfs"
 DEBUG = False
 VERSION = "0.0.3"
 
-DEVICE_LIST = []
-DEVICE_PROGRESS = Array("I", [])
-DEVICE_STATUS = Array("B", [])
-TASK_LIST = Array("I", [])
+DEVICE_EVENTS = None  # Queue of the devices whose progress or status has changed
+DEVICE_PROGRESS = memoryview(b"")
+DEVICE_SHM = None  # The shared memory behind DEVICE_PROGRESS and DEVICE_STATUS
+DEVICE_STATUS = memoryview(b"")
+FAST_VERIFY = False  # Verify NVMe devices with the drive's Compare command
+NVME_CMD_COMPARE = 0x05
+NVME_IOCTL_ID = 0x4E40  # _IO('N', 0x40)
+NVME_IOCTL_IO_CMD = 0xC0484E43  # _IOWR('N', 0x43, struct nvme_passthru_cmd)
+NVME_SC_COMPARE_FAILED = 0x285
+NVME_STATUS_MASK = 0x7FF  # The status code type and status code, without the More and Do Not Retry bits
+TASK_LIST = []  # The rich progress task id of each device, only used by the main process
+STATUS_DESCRIPTIONS = {
+    0: "waiting to start",
+    1: "writing 'aa'",
+    2: "verifying 'aa'",
+    3: "writing '55'",
+    4: "verifying '55'",
+    5: "writing 'ff'",
+    6: "verifying 'ff'",
+    7: "writing '00'",
+    8: "verifying '00'",
+    9: "writing random data",
+    10: "verifying random data",
+    20: "verification failed",
+    30: "completed successfully",
+}
+TEST_BYTES = (b"\xaa", b"\x55", b"\xff", b"\x00")  # The patterns tested, in order
+TEST_NAMES = (
+    "aa",
+    "55",
+    "ff",
+    "00",
+    "random data",
+)  # Each of TEST_BYTES, then the random data
+TEST_PASSES = 4  # 4 tests with each of TEST_BYTES, 1 tests with random data instead
+URING_BATCH_SIZE = 32  # The most blocks in flight through io_uring at once
+URING_QUEUE_DEPTH = 64
+URING_IOPOLL = False  # Busy-poll for completions on devices with poll queues, instead of waiting for interrupts
+URING_REAP_SIZE = 8  # The completions waited for once the most blocks are in flight
+URING_SQPOLL = False  # Poll for submissions from a kernel thread, saving syscalls
+USE_URING = liburing is not None
+VECTOR_BLOCKS = 8  # The blocks moved by each preadv/pwritev call without io_uring
+VERIFY_STATUS = (
+    2,
+    4,
+    6,
+    8,
+    10,
+)  # The DEVICE_STATUS value when verifying each of TEST_NAMES
 WRITE_SIZE = 1024 * 1024  # The default number of bytes to use for reads and writes
+WRITE_STATUS = (
+    1,
+    3,
+    5,
+    7,
+    9,
+)  # The DEVICE_STATUS value when writing each of TEST_NAMES
+
+# One WRITE_SIZE block of each test byte, built once here so the forked workers all share them
+TEST_PATTERNS = tuple(test_byte * WRITE_SIZE for test_byte in TEST_BYTES)
+RANDOM_PATTERN_ID = len(TEST_BYTES)  # The pattern_id used for the random data
 
 CURSOR_ROW = 0
 CURSOR_VISIBLE = True
@@ -84,6 +156,299 @@ def _(event):
     print(layout)
 
 
+class NvmeCompareEngine:
+    """
+    Verifies blocks with the NVMe Compare command, so the drive checks them against the pattern and the data is
+    never read back
+    """
+
+    def __init__(
+        self, fd, logical_block_size, alignment=mmap.PAGESIZE, max_transfer=WRITE_SIZE
+    ):
+        self.fd = fd
+        self.logical_block_size = logical_block_size
+        self.pattern = aligned_buffer(WRITE_SIZE, alignment)
+        self.pattern_array = (ctypes.c_char * WRITE_SIZE).from_buffer(self.pattern)
+        # The blocks are only read back to report where they differ from the pattern
+        self.read_buffer = aligned_buffer(WRITE_SIZE, alignment)
+        pattern_address = ctypes.addressof(self.pattern_array)
+        self.stamped = False
+        nsid = fcntl.ioctl(fd, NVME_IOCTL_ID)
+
+        # A single command can't move more than the controller's maximum transfer size, which is often less than
+        # WRITE_SIZE, so each block is compared in as many pieces as that needs
+        piece_size = max(logical_block_size, min(WRITE_SIZE, max_transfer))
+        piece_size -= piece_size % logical_block_size
+        self.cmds = []
+        for offset in range(0, WRITE_SIZE, piece_size):
+            length = min(piece_size, WRITE_SIZE - offset)
+            cmd = NvmePassthruCmd(
+                opcode=NVME_CMD_COMPARE,
+                nsid=nsid,
+                addr=pattern_address + offset,
+                data_len=length,
+                cdw12=length // logical_block_size
+                - 1,  # The number of blocks, zero based
+            )
+            self.cmds.append((offset // logical_block_size, cmd))
+
+        # Not every drive supports Compare, or compares of this size, so check before relying on it
+        status = self.compare(0)
+        if status not in (0, NVME_SC_COMPARE_FAILED):
+            raise OSError(f"NVMe Compare returned status {status:#x}")
+
+    def close(self):
+        del self.pattern_array
+
+    def compare(self, seek_position) -> int:
+        """
+        Has the drive compare the block at seek_position against the test pattern
+        :return: The NVMe status of the command
+        """
+        if self.stamped:
+            BLOCK_STAMP.pack_into(self.pattern, 0, seek_position)
+        block_start = seek_position // self.logical_block_size
+        for block_offset, cmd in self.cmds:
+            start_block = block_start + block_offset
+            cmd.cdw10 = start_block & 0xFFFFFFFF
+            cmd.cdw11 = start_block >> 32
+            status = fcntl.ioctl(self.fd, NVME_IOCTL_IO_CMD, cmd) & NVME_STATUS_MASK
+            if status:
+                return status
+        return 0
+
+    def flush(self) -> bool:
+        return True
+
+    def read(self, seek_position) -> bool:
+        """
+        Compares a block against the test pattern
+        :return: False if the block didn't match, or couldn't be compared
+        """
+        try:
+            status = self.compare(seek_position)
+        except OSError as e:
+            print(e.with_traceback(None))
+            return False
+        if status == 0:
+            return True
+        if status != NVME_SC_COMPARE_FAILED:
+            print(
+                f"NVMe Compare of the block at byte {seek_position} returned status {status:#x}"
+            )
+            return False
+
+        # The drive only says the block differs, so read it back to find out where
+        try:
+            bytes_read = os.preadv(self.fd, [self.read_buffer], seek_position)
+        except OSError as e:
+            print(e.with_traceback(None))
+            bytes_read = 0
+        if bytes_read == WRITE_SIZE and self.read_buffer != self.pattern:
+            report_mismatch(self.read_buffer, self.pattern, seek_position)
+        else:
+            print(f"Verification failed in the block at byte {seek_position}")
+        return False
+
+    def set_pattern(self, test_array, stamped=False):
+        self.pattern[:] = test_array
+        self.stamped = stamped
+
+
+class NvmePassthruCmd(ctypes.Structure):
+    """
+    The Linux struct nvme_passthru_cmd, used to send commands to NVMe drives
+    """
+
+    _fields_ = [
+        ("opcode", ctypes.c_uint8),
+        ("flags", ctypes.c_uint8),
+        ("rsvd1", ctypes.c_uint16),
+        ("nsid", ctypes.c_uint32),
+        ("cdw2", ctypes.c_uint32),
+        ("cdw3", ctypes.c_uint32),
+        ("metadata", ctypes.c_uint64),
+        ("addr", ctypes.c_uint64),
+        ("metadata_len", ctypes.c_uint32),
+        ("data_len", ctypes.c_uint32),
+        ("cdw10", ctypes.c_uint32),
+        ("cdw11", ctypes.c_uint32),
+        ("cdw12", ctypes.c_uint32),
+        ("cdw13", ctypes.c_uint32),
+        ("cdw14", ctypes.c_uint32),
+        ("cdw15", ctypes.c_uint32),
+        ("timeout_ms", ctypes.c_uint32),
+        ("result", ctypes.c_uint32),
+    ]
+
+
+class UringDiskEngine:
+    """
+    Streams the reads and writes for a device through io_uring, keeping many blocks in flight at once instead of one
+    """
+
+    def __init__(
+        self, fd, alignment=mmap.PAGESIZE, depth=URING_BATCH_SIZE, iopoll=False
+    ):
+        self.depth = depth  # The most blocks in flight at once
+        self.ring = liburing.Ring()
+        self.cqe = liburing.Cqe()
+        flags = liburing.IORING_SETUP_SQPOLL if URING_SQPOLL else 0
+        if iopoll:
+            # Waiting for completions then polls the device's queues, which only works with O_DIRECT
+            flags |= liburing.IORING_SETUP_IOPOLL
+        liburing.io_uring_queue_init(URING_QUEUE_DEPTH, self.ring, flags)
+
+        # Buffer 0 holds the test pattern, the others receive the blocks read back when verifying
+        self.buffers = [aligned_buffer(WRITE_SIZE, alignment) for _ in range(depth + 1)]
+        self.iovecs = liburing.Iovec(self.buffers)
+        liburing.io_uring_register_buffers(self.ring, self.iovecs)
+
+        # The device is registered as fixed file 0
+        self.files = liburing.FileIndex([fd])
+        liburing.io_uring_register_files(self.ring, self.files)
+        self.free_buffers = list(range(1, depth + 1))
+        self.positions = [0] * (depth + 1)  # Where each buffer was read from
+        self.read_back = [False] * (
+            depth + 1
+        )  # Whether each buffer is being read into, or written from
+        self.in_flight = 0
+        self.stamped = False
+        self.succeeded = True
+
+    def close(self):
+        liburing.io_uring_unregister_files(self.ring)
+        liburing.io_uring_unregister_buffers(self.ring)
+        liburing.io_uring_queue_exit(self.ring)
+
+    def flush(self) -> bool:
+        """
+        Waits for all of the queued blocks to complete
+        :return: False if any of the blocks since the last flush failed to be written or didn't match the test pattern
+        """
+        while self.in_flight:
+            self.reap(self.in_flight)
+        succeeded = self.succeeded
+        self.succeeded = True
+        return succeeded
+
+    def queued(self) -> bool:
+        """
+        Finishes queueing a block, giving up on the rest of the pass if an earlier block failed
+        :return: False if a block has failed
+        """
+        self.in_flight += 1
+        if not self.succeeded:
+            # Let the other blocks finish, so nothing is still in flight when the caller gives up
+            return self.flush()
+        return True
+
+    def read(self, seek_position) -> bool:
+        """
+        Queues a block to be read back and compared against the test pattern
+        :return: False if a block has failed
+        """
+        if not self.free_buffers:
+            self.reap(min(URING_REAP_SIZE, self.in_flight))
+        buf_index = self.free_buffers.pop()
+        self.positions[buf_index] = seek_position
+        self.read_back[buf_index] = True
+        sqe = liburing.io_uring_get_sqe(self.ring)
+        liburing.io_uring_prep_read_fixed(
+            sqe, 0, self.buffers[buf_index], buf_index, seek_position
+        )
+        liburing.io_uring_sqe_set_flags(sqe, liburing.IOSQE_FIXED_FILE)
+        liburing.io_uring_sqe_set_data64(sqe, buf_index)
+        return self.queued()
+
+    def reap(self, wait_nr):
+        """
+        Submits the queued blocks, then handles the completed ones after waiting for wait_nr of them.  Buffers of
+        blocks which have been read are checked against the test pattern, then become free for reuse
+        """
+        try:
+            liburing.io_uring_submit_and_wait(self.ring, wait_nr)
+        except OSError as e:
+            print(e.with_traceback(None))
+            self.succeeded = False
+
+        for _ in range(liburing.io_uring_cq_ready(self.ring)):
+            # Looking at a failed completion raises its error, but its user data can still be read afterwards
+            try:
+                liburing.io_uring_peek_cqe(self.ring, self.cqe)
+                matched = self.cqe[0].res == WRITE_SIZE
+            except OSError as e:
+                print(e.with_traceback(None))
+                matched = False
+            buf_index = self.cqe[0].user_data
+            if buf_index != 0:
+                if matched and self.read_back[buf_index]:
+                    # Blocks of stamped patterns are only expected to match once buffer 0 has their offset too
+                    if self.stamped:
+                        BLOCK_STAMP.pack_into(
+                            self.buffers[0], 0, self.positions[buf_index]
+                        )
+                    if self.buffers[buf_index] != self.buffers[0]:
+                        report_mismatch(
+                            self.buffers[buf_index],
+                            self.buffers[0],
+                            self.positions[buf_index],
+                        )
+                        matched = False
+                self.free_buffers.append(buf_index)
+            if not matched:
+                self.succeeded = False
+            liburing.io_uring_cq_advance(self.ring, 1)
+            self.in_flight -= 1
+
+    def set_pattern(self, test_array, stamped=False):
+        """
+        Sets the test pattern.  When it's stamped, each block starts with its own byte offset, so the blocks are
+        written from copies of the pattern in the other buffers instead of all sharing buffer 0
+        """
+        self.buffers[0][:] = test_array
+        self.stamped = stamped
+        if stamped:
+            for buf_index in self.free_buffers:
+                self.buffers[buf_index][:] = test_array
+
+    def write(self, seek_position) -> bool:
+        """
+        Queues a block of the test pattern to be written
+        :return: False if a block has failed
+        """
+        buf_index = 0
+        if self.stamped:
+            if not self.free_buffers:
+                self.reap(min(URING_REAP_SIZE, self.in_flight))
+            buf_index = self.free_buffers.pop()
+            self.read_back[buf_index] = False
+            BLOCK_STAMP.pack_into(self.buffers[buf_index], 0, seek_position)
+        elif self.in_flight == self.depth:
+            self.reap(min(URING_REAP_SIZE, self.in_flight))
+        sqe = liburing.io_uring_get_sqe(self.ring)
+        liburing.io_uring_prep_write_fixed(
+            sqe, 0, self.buffers[buf_index], buf_index, seek_position
+        )
+        liburing.io_uring_sqe_set_flags(sqe, liburing.IOSQE_FIXED_FILE)
+        liburing.io_uring_sqe_set_data64(sqe, buf_index)
+        return self.queued()
+
+
+def aligned_buffer(size, alignment=mmap.PAGESIZE) -> bytearray:
+    """
+    Returns a bytearray whose contents start on an alignment boundary, as needed for O_DIRECT I/O
+    :return:
+    """
+    buf = bytearray(size + alignment)
+    address = ctypes.addressof(ctypes.c_char.from_buffer(buf))
+
+    # Trimming the front of a bytearray just moves its start pointer, so this doesn't copy anything
+    del buf[: -address % alignment]
+    del buf[size:]
+    return buf
+
+
 def build_drive_list_panel(selected_row=0) -> Panel:
     global CURSOR_VISIBLE
     global drive_list
@@ -120,6 +485,25 @@ def build_drive_list_panel(selected_row=0) -> Panel:
     return Panel(drive_list_table)
 
 
+def create_device_slots(num_drives):
+    """
+    Creates the shared memory used to report each device's progress and status back to the main process.  Each
+    device gets its own cache line, so the workers updating them don't keep invalidating each other's caches
+    :return:
+    """
+    global DEVICE_PROGRESS, DEVICE_SHM, DEVICE_STATUS
+
+    DEVICE_SHM = shared_memory.SharedMemory(
+        create=True, size=num_drives * CACHE_LINE_SIZE
+    )
+    words = DEVICE_SHM.buf.cast("I")
+    words_per_slot = CACHE_LINE_SIZE // words.itemsize
+
+    # The first word of each slot is the progress, and the second is the status
+    DEVICE_PROGRESS = words[0::words_per_slot]
+    DEVICE_STATUS = words[1::words_per_slot]
+
+
 def get_drive_list(selected_devices=None) -> list:
     try:
         lsblk_output = subprocess.check_output(
@@ -132,32 +516,31 @@ def get_drive_list(selected_devices=None) -> list:
         print("lsblk doesn't seem to exist at {CMD_LSBLK}")
         return []
 
-    drives_json = rapidjson.loads(lsblk_output)
+    drives_json = json.loads(lsblk_output)
 
     # Get the zfs volume list
     zfs_vol_list = get_zfs_volumes()
 
+    # Work out the device names and ZFS pool/dataset names of the drives selected on the command line up front
+    selected_names = set()
+    selected_datasets = set()
+    for sel in selected_devices or []:
+        selected_names.add(os.path.basename(sel))
+        selected_datasets.add(str(sel).removeprefix("/dev/zvol/"))
+
     drives = []
     for drive in drives_json["blockdevices"]:
         if drive["type"] == "disk":
-            # Check if the drive was selected on the command line
-            selected = False
-            if selected_devices:
-                for sel in selected_devices:
-                    friendly_name = str(sel).split("/")[-1:][0]
-
-                    # Check if the selected device matches the /dev/zd[number] name
-                    if drive["name"] == friendly_name:
-                        selected = True
-
-                    # Check if the selected device matches the ZFS pool/dataset name
-                    pool_dataset = str(sel).removeprefix("/dev/zvol/")
-                    for zfs_volume in zfs_vol_list:
-                        if (
-                            drive["name"] == zfs_volume["device_name"]
-                            and pool_dataset == zfs_volume["name"]
-                        ):
-                            selected = True
+            # Check if the selected device matches the /dev/zd[number] name
+            selected = drive["name"] in selected_names
+
+            # Check if the selected device matches the ZFS pool/dataset name
+            for zfs_volume in zfs_vol_list:
+                if (
+                    drive["name"] == zfs_volume["device_name"]
+                    and zfs_volume["name"] in selected_datasets
+                ):
+                    selected = True
 
             # If the name matches a zfs volume device, then we use pool/dataset for the name instead
             zfs = False
@@ -184,6 +567,76 @@ def get_drive_list(selected_devices=None) -> list:
     return sorted(drives, key=lambda entry: entry["name"])
 
 
+def get_io_poll(device) -> bool:
+    """
+    Finds whether a device has queues set aside for polled I/O, such as NVMe drives with the poll_queues option set
+    :return: True if completions for the device can be polled for
+    """
+    try:
+        with open(os.path.join(get_sysfs_path(device), "queue", "io_poll")) as f:
+            return f.read().strip() == "1"
+    except OSError:
+        return False
+
+
+def get_max_transfer(device) -> int:
+    """
+    Finds the largest single transfer the device's controller supports
+    :return: The size in bytes, or 0 if it isn't known
+    """
+    try:
+        with open(
+            os.path.join(get_sysfs_path(device), "queue", "max_hw_sectors_kb")
+        ) as f:
+            return int(f.read()) * 1024
+    except (OSError, ValueError):
+        return 0
+
+
+def get_numa_cpus(device) -> set:
+    """
+    Finds the CPUs on the same NUMA node as the controller a device is attached to
+    :return: The CPU numbers, or an empty set if the device's NUMA node isn't known
+    """
+    sys_path = os.path.realpath(get_sysfs_path(device))
+
+    # The NUMA node is recorded on the PCI device, which is somewhere above the block device in sysfs
+    while sys_path != "/sys/devices" and sys_path != "/":
+        try:
+            with open(os.path.join(sys_path, "numa_node")) as numa_file:
+                numa_node = int(numa_file.read())
+            break
+        except (FileNotFoundError, ValueError):
+            sys_path = os.path.dirname(sys_path)
+    else:
+        return set()
+    if numa_node < 0:
+        return set()
+
+    # The node's CPUs are listed like "0-7,16-23"
+    cpus = set()
+    try:
+        with open(f"/sys/devices/system/node/node{numa_node}/cpulist") as cpu_file:
+            for cpu_range in cpu_file.read().strip().split(","):
+                first, _, last = cpu_range.partition("-")
+                cpus.update(range(int(first), int(last or first) + 1))
+    except (FileNotFoundError, ValueError):
+        return set()
+    return cpus & os.sched_getaffinity(0)
+
+
+def get_queue_depth(device) -> int:
+    """
+    Finds how many requests the kernel will queue up for a device
+    :return: The number of requests, or 0 if it isn't known
+    """
+    try:
+        with open(os.path.join(get_sysfs_path(device), "queue", "nr_requests")) as f:
+            return int(f.read())
+    except (OSError, ValueError):
+        return 0
+
+
 def get_selected_devices() -> list:
     global drive_list
 
@@ -198,6 +651,14 @@ def get_selected_devices() -> list:
     return selection_list
 
 
+def get_sysfs_path(device) -> str:
+    """
+    Works out where a device lives under /sys/class/block, following symlinks such as the /dev/zvol/ ones
+    :return:
+    """
+    return os.path.join("/sys/class/block", os.path.basename(os.path.realpath(device)))
+
+
 def get_zfs_volumes() -> list:
     """
     If zfs is present, then this function returns a list of the zfs block devices along with some useful metadata
@@ -213,40 +674,23 @@ def get_zfs_volumes() -> list:
             print("zfs command not found")
         return []
 
-    # Retrieve the list of ZFS data sets
+    # Retrieve the name and size of every ZFS volume in one go
     try:
-        cmd_output = subprocess.Popen(
-            [CMD_ZFS, "list", "-p", "-H"],
-            stdout=subprocess.PIPE,
+        zfs_list_volumes = subprocess.check_output(
+            [CMD_ZFS, "list", "-H", "-t", "volume", "-o", "name,volsize"],
             universal_newlines=True,
-        )
-        zfs_list_datasets = cmd_output.stdout.readlines()
+        ).splitlines()
     except subprocess.CalledProcessError:
         print("Calling zfs list failed.  Aborting!")
         return []
-    zfs_datasets = []
-    for line in zfs_list_datasets:
-        zfs_datasets.append(line.split()[0:1][0])
     if DEBUG:
-        print(zfs_datasets)
+        print(zfs_list_volumes)
 
     # Separate out the list of ZFS volumes
     zfs_volumes = []
-    zfs_list_volumes = []
-    for dataset in zfs_datasets:
-        try:
-            cmd_output = subprocess.Popen(
-                [CMD_ZFS, "get", "-H", "volsize", dataset],
-                stdout=subprocess.PIPE,
-                universal_newlines=True,
-            )
-            zfs_list_volumes.append(cmd_output.stdout.read())
-        except subprocess.CalledProcessError:
-            print("Calling zfs list failed.  Aborting!")
-            return []
     for volume in zfs_list_volumes:
         z = volume.split()
-        if z[2] != "-":
+        if len(z) == 2 and z[1] != "-":
             # Split the volume name into pool/dataset components
             pool = z[0].split("/")[0]
             dataset_path = z[0].removeprefix(pool + "/")
@@ -266,7 +710,7 @@ def get_zfs_volumes() -> list:
             zfs_volumes.append(
                 {
                     "name": z[0],
-                    "size": z[2],
+                    "size": z[1],
                     "pool": pool,
                     "path": dataset_path,
                     "device_name": device_name,
@@ -277,40 +721,51 @@ def get_zfs_volumes() -> list:
     return zfs_volumes
 
 
-def test_disk(device):
-    global DEBUG, DEVICE_LIST, DEVICE_PROGRESS, DEVICE_STATUS, WRITE_SIZE
+def report_change(list_element):
+    """
+    Lets the main process know the progress or status of a device has changed
+    :return:
+    """
+    if DEVICE_EVENTS is not None:
+        DEVICE_EVENTS.put(list_element)
 
-    # Determine which DEVICE_LIST element number we've been passed
-    list_element = 0
-    found = False
-    for element in DEVICE_LIST:
-        if element == device:
-            found = True
-            break
-        else:
-            list_element += 1
 
-    if found is False:
-        print(f"{device} not found in DEVICE_LIST.  Aborting.")
-        return False
+def report_mismatch(read_buffer, comparison_array, seek_position):
+    """
+    Reports where a block read back first differs from the test pattern.  This is only used once a comparison has
+    already failed
+    :return:
+    """
+    # Narrow the search down a page at a time, then a byte at a time within the page that differs
+    offset = 0
+    while (
+        read_buffer[offset : offset + mmap.PAGESIZE]
+        == comparison_array[offset : offset + mmap.PAGESIZE]
+    ):
+        offset += mmap.PAGESIZE
+    while read_buffer[offset] == comparison_array[offset]:
+        offset += 1
+    print(
+        f"Verification failed at byte {seek_position + offset}: expected {comparison_array[offset]:#04x}, "
+        f"read {read_buffer[offset]:#04x}"
+    )
 
-    # Get the total size of the device
-    try:
-        json_output = subprocess.check_output([CMD_LSBLK, "-bdJo", "name,size", device])
-        device_size = rapidjson.loads(json_output)["blockdevices"][0]["size"]
-    except subprocess.CalledProcessError:
-        print(f"Couldn't run lsblk on {device}.  Aborting!")
-        return False
-    except Exception as e:
-        print("Something went wrong when trying to run lsblk")
-        print(e.with_traceback(None))
-        return False
 
-    if DEBUG:
-        print(f"Total size of '{device}': {round(device_size / (1024 * 1024))} MB")
+def test_disk(task):
+    global DEBUG, DEVICE_PROGRESS, DEVICE_STATUS, WRITE_SIZE
+
+    # The device's position in the list of selected devices is passed along with it
+    list_element, device = task
+
+    # Keep the worker on the CPUs nearest to the device, or failing that spread the workers out over the CPUs
+    cpus = get_numa_cpus(device)
+    if not cpus:
+        allowed_cpus = sorted(os.sched_getaffinity(0))
+        cpus = {allowed_cpus[list_element % len(allowed_cpus)]}
+    os.sched_setaffinity(0, cpus)
 
     # Open the device for read-write operations
-    num_blocks_in_device = round(device_size / WRITE_SIZE)
+    direct_io = True
     try:
         # To add Windows support, apparently "os.O_BINARY" would need to be added
         device_handle = os.open(path=device, flags=os.O_DIRECT | os.O_RDWR)
@@ -322,38 +777,138 @@ def test_disk(device):
     except PermissionError:
         print(f"Trying to open '{device}' for writing failed. Did you forget sudo?")
         return False
-    file_handle = os.fdopen(fd=device_handle, mode="rb+", buffering=0)
+    except OSError as e:
+        if e.errno != errno.EINVAL:
+            print(f"Trying to open '{device}' failed: {e}")
+            return False
 
-    # Test the device with various characters
+        # The device doesn't support O_DIRECT, so go through the page cache instead
+        print(
+            f"'{device}' doesn't support O_DIRECT, so its reads and writes will be cached"
+        )
+        device_handle = os.open(path=device, flags=os.O_RDWR)
+        direct_io = False
+
+    # Some drivers quietly ignore O_DIRECT, so check it actually took effect
+    if direct_io and not fcntl.fcntl(device_handle, fcntl.F_GETFL) & os.O_DIRECT:
+        print(
+            f"O_DIRECT didn't take effect for '{device}', so its reads and writes will be cached"
+        )
+        direct_io = False
+    if not direct_io:
+        os.posix_fadvise(device_handle, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+    # Get the total size and logical block size of the device
+    try:
+        device_size = struct.unpack(
+            "Q", fcntl.ioctl(device_handle, BLKGETSIZE64, bytes(8))
+        )[0]
+        logical_block_size = struct.unpack(
+            "i", fcntl.ioctl(device_handle, BLKSSZGET, bytes(4))
+        )[0]
+    except OSError as e:
+        print(f"Couldn't get the size of '{device}'.  Aborting!")
+        print(e.with_traceback(None))
+        os.close(device_handle)
+        return False
+
+    if DEBUG:
+        print(f"Total size of '{device}': {round(device_size / (1024 * 1024))} MB")
+
+    # O_DIRECT needs every transfer, offset, and buffer address to be a multiple of the logical block size
+    if WRITE_SIZE % logical_block_size != 0 or device_size % logical_block_size != 0:
+        print(
+            f"'{device}' has a logical block size of {logical_block_size} bytes, which doesn't fit "
+            f"evenly into its size or the {WRITE_SIZE} byte write size.  Aborting."
+        )
+        os.close(device_handle)
+        return False
+    alignment = max(mmap.PAGESIZE, logical_block_size)
+
+    # Use io_uring for the reads and writes when it's available
+    # Don't keep more blocks in flight than the kernel will queue for the device, as the extra would just wait
+    engine = None
+    if USE_URING:
+        queue_depth = get_queue_depth(device) or URING_BATCH_SIZE
+        iopoll = URING_IOPOLL and direct_io and get_io_poll(device)
+        if URING_IOPOLL and not iopoll:
+            print(
+                f"'{device}' doesn't support polled I/O, waiting for interrupts instead"
+            )
+        try:
+            engine = UringDiskEngine(
+                device_handle, alignment, min(URING_BATCH_SIZE, queue_depth), iopoll
+            )
+        except OSError as e:
+            print(f"Couldn't set up io_uring for '{device}', using pread/pwrite: {e}")
+
+    # With --fast-verify, NVMe drives compare the blocks themselves instead of them being read back
+    verify_engine = engine
+    if FAST_VERIFY:
+        max_transfer = get_max_transfer(device) or WRITE_SIZE
+        try:
+            verify_engine = NvmeCompareEngine(
+                device_handle, logical_block_size, alignment, max_transfer
+            )
+        except OSError as e:
+            print(
+                f"Couldn't use NVMe Compare for '{device}', reading it back instead: {e}"
+            )
+
+    # The buffers are allocated once and reused for every block.  Reading back without an engine needs a buffer
+    # for each block of a preadv() call, as does writing the random data, since each block of it is different
+    stamped = TEST_PASSES == 1
+    write_buffers = [
+        aligned_buffer(WRITE_SIZE, alignment)
+        for _ in range(VECTOR_BLOCKS if stamped and not engine else 1)
+    ]
+    write_buffer = write_buffers[0]
+    read_buffers = [
+        aligned_buffer(WRITE_SIZE, alignment)
+        for _ in range(1 if verify_engine else VECTOR_BLOCKS)
+    ]
+
+    # Test the device with various characters, or with a single pass of random data.  The random data is one
+    # block's worth repeated across the device, with each block stamped with its own byte offset.  That way a device
+    # which wraps around or aliases addresses, such as fake capacity flash, fails verification
+    if TEST_PASSES == 1:
+        test_patterns = [(RANDOM_PATTERN_ID, os.urandom(WRITE_SIZE))]
+    else:
+        test_patterns = enumerate(TEST_PATTERNS)
     verify_succeeded = True
-    for test_byte in [
-        bytearray.fromhex("aa"),
-        bytearray.fromhex("55"),
-        bytearray.fromhex("ff"),
-        bytearray.fromhex("00"),
-    ]:
-        # Create a byte array of the character being tested
-        test_array = bytearray()
-        for i in range(WRITE_SIZE):
-            test_array += test_byte
+    for pattern_id, test_pattern in test_patterns:
+        # Fill the write buffers with the pattern being tested
+        for buffer in write_buffers:
+            buffer[:] = test_pattern
+        if engine:
+            engine.set_pattern(write_buffer, stamped)
+        if verify_engine and verify_engine is not engine:
+            verify_engine.set_pattern(write_buffer, stamped)
 
         # Write to the device
         write_status = False
         try:
             write_status = write_disk(
                 list_element,
-                file_handle,
-                num_blocks_in_device,
-                test_array,
-                test_byte,
+                device_handle,
+                device_size,
+                write_buffers,
+                pattern_id,
+                engine,
             )
         except Exception as e:
             print(e.with_traceback(None))
             return False
         if not write_status:
-            print(f"Writing {test_byte} to {device} failed!")
+            print(f"Writing {TEST_NAMES[pattern_id]} to {device} failed!")
             return False
 
+        # Without O_DIRECT, flush the written pattern to the device and drop it from the page cache, so the
+        # verification reads it back from the device itself
+        if not direct_io:
+            os.fsync(device_handle)
+            os.posix_fadvise(device_handle, 0, 0, os.POSIX_FADV_DONTNEED)
+
         # Verify writing to the device worked
         # TODO: This feels like a dodgy way to check the verification worked?
         # verify_status = False
@@ -361,10 +916,12 @@ def test_disk(device):
         # TODO: Put this back into a try block when I have some idea about the errors that can be returned
         verify_status = verify_disk(
             list_element,
-            file_handle,
-            num_blocks_in_device,
-            test_array,
-            test_byte,
+            device_handle,
+            device_size,
+            write_buffer,
+            pattern_id,
+            read_buffers,
+            verify_engine,
         )
         # except:
         #     print(f"Reading from '{device}' failed!")
@@ -372,14 +929,21 @@ def test_disk(device):
         #     break
         if not verify_status:
             verify_succeeded = False
-            print(f"Verifying {test_byte} on {device} failed!")
+            print(f"Verifying {TEST_NAMES[pattern_id]} on {device} failed!")
+        if not direct_io:
+            os.posix_fadvise(device_handle, 0, 0, os.POSIX_FADV_DONTNEED)
 
     # Close the device
-    file_handle.close()
+    if engine:
+        engine.close()
+    if verify_engine and verify_engine is not engine:
+        verify_engine.close()
+    os.close(device_handle)
     if verify_succeeded:
         DEVICE_STATUS[list_element] = 30  # Disk testing was successful
     else:
         DEVICE_STATUS[list_element] = 20  # Disk testing failed
+    report_change(list_element)
     return True
 
 
@@ -413,88 +977,187 @@ def update_drive_selection():
 
 def verify_disk(
     list_element,
-    file_to_be_read,
-    num_blocks_in_device,
+    device_handle,
+    device_size,
     comparison_array,
-    expected_byte,
+    pattern_id,
+    read_buffers,
+    engine=None,
 ) -> bool:
-    global DEVICE_LIST, DEVICE_PROGRESS, DEVICE_STATUS, WRITE_SIZE
-    if expected_byte == bytearray.fromhex("aa"):
-        DEVICE_STATUS[list_element] = 2
-    elif expected_byte == bytearray.fromhex("55"):
-        DEVICE_STATUS[list_element] = 4
-    elif expected_byte == bytearray.fromhex("ff"):
-        DEVICE_STATUS[list_element] = 6
-    elif expected_byte == bytearray.fromhex("00"):
-        DEVICE_STATUS[list_element] = 8
-
-    # Set up progress counter output
-    progress_counter_blocks = round(num_blocks_in_device / 100)
+    global DEVICE_PROGRESS, DEVICE_STATUS, WRITE_SIZE
+    # The progress is reset before the status changes, so the new status is never shown with the old progress
     DEVICE_PROGRESS[list_element] = 0
-
-    for block_number in range(num_blocks_in_device):
-        seek_position = block_number * WRITE_SIZE
-
+    DEVICE_STATUS[list_element] = VERIFY_STATUS[pattern_id]
+
+    # The device is processed in WRITE_SIZE blocks, with any remainder handled separately at the end
+    num_blocks_in_device, tail_size = divmod(device_size, WRITE_SIZE)
+
+    # Set up progress counter output.  The steps are about 1% of the device, but the percentage reported is worked
+    # out from the blocks actually done, so it stays accurate when the blocks don't divide evenly into 100 steps
+    progress_counter_blocks = max(1, num_blocks_in_device // 100)
+    progress = 0
+    report_change(list_element)
+
+    # Bind the per-block call once, as the inner loops below run for every block.  Without an engine, each
+    # preadv() call fills all of read_buffers so the kernel gets several blocks to queue at once
+    preadv = os.preadv
+    read_buffer = read_buffers[0]
+    vector_bytes = len(read_buffers) * WRITE_SIZE
+
+    # Each block of random data starts with its own byte offset, so the expected data is stamped to match
+    stamp = BLOCK_STAMP.pack_into if pattern_id == RANDOM_PATTERN_ID else None
+
+    # Work through the device one progress step at a time, so the inner loops only do the reads and comparisons
+    step_bytes = progress_counter_blocks * WRITE_SIZE
+    device_bytes = num_blocks_in_device * WRITE_SIZE
+    for step_start in range(0, device_bytes, step_bytes):
         # Update the reported progress percentage
-        if block_number % progress_counter_blocks == 0:
-            DEVICE_PROGRESS[list_element] += 1
+        step_progress = step_start // WRITE_SIZE * 100 // num_blocks_in_device
+        if step_progress != progress:
+            progress = step_progress
+            DEVICE_PROGRESS[list_element] = progress
+            report_change(list_element)
 
         # Read the test byte from disk
-        m = mmap.mmap(
-            fileno=file_to_be_read.fileno(),
-            length=WRITE_SIZE,
-            offset=seek_position,
+        step_end = min(step_start + step_bytes, device_bytes)
+        if engine:
+            for seek_position in range(step_start, step_end, WRITE_SIZE):
+                if not engine.read(seek_position):
+                    return False
+            continue
+        # Comparing the bytearrays directly is a single memcmp(), whereas comparing memoryviews goes element by
+        # element and is 10-100x slower
+        for vector_position in range(step_start, step_end, vector_bytes):
+            buffers = read_buffers
+            if vector_position + vector_bytes > step_end:
+                buffers = read_buffers[: (step_end - vector_position) // WRITE_SIZE]
+            bytes_read = preadv(device_handle, buffers, vector_position)
+            if bytes_read != len(buffers) * WRITE_SIZE:
+                print(
+                    f"Only {bytes_read} bytes could be read at byte {vector_position}"
+                )
+                return False
+            for seek_position, buffer in zip(
+                range(vector_position, step_end, WRITE_SIZE), buffers
+            ):
+                if stamp:
+                    stamp(comparison_array, 0, seek_position)
+                if buffer != comparison_array:
+                    report_mismatch(buffer, comparison_array, seek_position)
+                    return False
+    if engine and not engine.flush():
+        return False
+
+    # Read the final partial block
+    if tail_size:
+        seek_position = num_blocks_in_device * WRITE_SIZE
+        if stamp:
+            stamp(comparison_array, 0, seek_position)
+        expected = memoryview(comparison_array)[:tail_size]
+        bytes_read = os.preadv(
+            device_handle, [memoryview(read_buffer)[:tail_size]], seek_position
         )
-        read_buffer = m.read(WRITE_SIZE)
-        if read_buffer != comparison_array:
-            # TODO: Better reporting of verification failure(s)
+        if bytes_read != tail_size:
+            print(f"Only {bytes_read} bytes could be read at byte {seek_position}")
             return False
-        m.close()
+        if not read_buffer.startswith(expected):
+            report_mismatch(read_buffer, expected, seek_position)
+            return False
+
+    # Everything has been verified
+    DEVICE_PROGRESS[list_element] = 100
+    report_change(list_element)
     return True
 
 
 def write_disk(
     list_element,
-    file_to_be_read,
-    num_blocks_in_device,
-    array_to_write,
-    test_byte,
+    device_handle,
+    device_size,
+    write_buffers,
+    pattern_id,
+    engine=None,
 ) -> bool:
-    global DEVICE_LIST, DEVICE_PROGRESS, DEVICE_STATUS, WRITE_SIZE
-    if test_byte == bytearray.fromhex("aa"):
-        DEVICE_STATUS[list_element] = 1
-    elif test_byte == bytearray.fromhex("55"):
-        DEVICE_STATUS[list_element] = 3
-    elif test_byte == bytearray.fromhex("ff"):
-        DEVICE_STATUS[list_element] = 5
-    elif test_byte == bytearray.fromhex("00"):
-        DEVICE_STATUS[list_element] = 7
-
-    # Set up progress counter output
-    progress_counter_blocks = round(num_blocks_in_device / 100)
+    global DEVICE_PROGRESS, DEVICE_STATUS, WRITE_SIZE
+    # The progress is reset before the status changes, so the new status is never shown with the old progress
     DEVICE_PROGRESS[list_element] = 0
+    DEVICE_STATUS[list_element] = WRITE_STATUS[pattern_id]
 
-    try:
-        for block_number in range(num_blocks_in_device):
-            seek_position = block_number * WRITE_SIZE
+    # The device is processed in WRITE_SIZE blocks, with any remainder handled separately at the end
+    num_blocks_in_device, tail_size = divmod(device_size, WRITE_SIZE)
+
+    # Set up progress counter output.  The steps are about 1% of the device, but the percentage reported is worked
+    # out from the blocks actually done, so it stays accurate when the blocks don't divide evenly into 100 steps
+    progress_counter_blocks = max(1, num_blocks_in_device // 100)
+    progress = 0
+    report_change(list_element)
+
+    # Bind the per-block call once, as the inner loops below run for every block.  Without an engine, each
+    # pwritev() call writes the pattern to VECTOR_BLOCKS blocks at once, so the kernel has several to queue
+    pwritev = os.pwritev
+    array_to_write = write_buffers[0]
+    vector_bytes = VECTOR_BLOCKS * WRITE_SIZE
 
+    # Each block of random data starts with its own byte offset, so it's written from a buffer per block of the
+    # pwritev() call.  The other patterns write the same buffer to every block
+    stamp = BLOCK_STAMP.pack_into if pattern_id == RANDOM_PATTERN_ID else None
+    if not stamp:
+        write_buffers = [array_to_write] * VECTOR_BLOCKS
+
+    try:
+        # Work through the device one progress step at a time, so the inner loops only do the writes
+        step_bytes = progress_counter_blocks * WRITE_SIZE
+        device_bytes = num_blocks_in_device * WRITE_SIZE
+        for step_start in range(0, device_bytes, step_bytes):
             # Update the reported progress percentage
-            if block_number % progress_counter_blocks == 0:
-                DEVICE_PROGRESS[list_element] += 1
+            step_progress = step_start // WRITE_SIZE * 100 // num_blocks_in_device
+            if step_progress != progress:
+                progress = step_progress
+                DEVICE_PROGRESS[list_element] = progress
+                report_change(list_element)
 
             # Write the test byte to disk
-            m = mmap.mmap(
-                fileno=file_to_be_read.fileno(),
-                length=WRITE_SIZE,
-                offset=seek_position,
-            )
-            m.write(array_to_write)
-            m.close()
+            step_end = min(step_start + step_bytes, device_bytes)
+            if engine:
+                for seek_position in range(step_start, step_end, WRITE_SIZE):
+                    if not engine.write(seek_position):
+                        return False
+                continue
+            for vector_position in range(step_start, step_end, vector_bytes):
+                buffers = write_buffers
+                if vector_position + vector_bytes > step_end:
+                    buffers = write_buffers[
+                        : (step_end - vector_position) // WRITE_SIZE
+                    ]
+                if stamp:
+                    for seek_position, buffer in zip(
+                        range(vector_position, step_end, WRITE_SIZE), buffers
+                    ):
+                        stamp(buffer, 0, seek_position)
+                if (
+                    pwritev(device_handle, buffers, vector_position)
+                    != len(buffers) * WRITE_SIZE
+                ):
+                    return False
+        if engine and not engine.flush():
+            return False
+
+        # Write the final partial block
+        if tail_size:
+            seek_position = num_blocks_in_device * WRITE_SIZE
+            if stamp:
+                stamp(array_to_write, 0, seek_position)
+            tail_buffer = memoryview(array_to_write)[:tail_size]
+            if os.pwrite(device_handle, tail_buffer, seek_position) != tail_size:
+                return False
     except Exception as e:
         # TODO: Better reporting of write failures
         print(e.with_traceback(None))
         return False
 
+    # Everything has been written
+    DEVICE_PROGRESS[list_element] = 100
+    report_change(list_element)
     return True
 
 
@@ -502,10 +1165,13 @@ def main():
     global \
         CURSOR_ROW, \
         CURSOR_VISIBLE, \
-        DEVICE_LIST, \
-        DEVICE_PROGRESS, \
-        DEVICE_STATUS, \
-        TASK_LIST
+        DEVICE_EVENTS, \
+        FAST_VERIFY, \
+        TASK_LIST, \
+        TEST_PASSES, \
+        URING_IOPOLL, \
+        URING_SQPOLL, \
+        USE_URING
     global drive_list, layout
 
     # Get the device name(s) to test
@@ -520,7 +1186,43 @@ def main():
         action="append",
         required=False,
     )
+    parser.add_argument(
+        "--no-uring",
+        help="use plain pread/pwrite for the disk reads and writes instead of io_uring",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--fast-verify",
+        help="verify NVMe devices with the drive's Compare command, instead of reading the data back",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--sqpoll",
+        help="have a kernel thread per device poll for io_uring submissions, trading CPU time for fewer syscalls",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--iopoll",
+        help="busy-poll for io_uring completions on devices with poll queues, trading CPU time for lower latency",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--passes",
+        help="4 (the default) tests with the same patterns as badblocks, 1 tests with a single pass of random data",
+        type=int,
+        choices=(1, 4),
+        default=4,
+    )
     args = parser.parse_args()
+    TEST_PASSES = args.passes
+    if args.fast_verify:
+        FAST_VERIFY = True
+    if args.no_uring:
+        USE_URING = False
+    if args.sqpoll:
+        URING_SQPOLL = True
+    if args.iopoll:
+        URING_IOPOLL = True
 
     # TODO: Require running as super-user
 
@@ -578,104 +1280,98 @@ def main():
 
     # Size the progress information arrays appropriately
     num_drives = len(selected_devices)
-    DEVICE_PROGRESS = Array("I", range(num_drives))
-    DEVICE_STATUS = Array("B", range(num_drives))
-    TASK_LIST = Array("I", range(num_drives))
-
-    cnt = 0
-    for device in selected_devices:
-        DEVICE_LIST.append(device)
-        friendly_name = str(device).split("/")[-1:][0]
-        TASK_LIST[cnt] = progress.add_task(
-            f"[cyan]{friendly_name} writing...", total=100
-        )
-        cnt += 1
+    create_device_slots(num_drives)
+
+    # The workers rely on inheriting the shared memory views and TEST_PATTERNS, so they're always forked.  The
+    # event queue comes from the same context, as the default start method isn't always fork
+    worker_context = get_context("fork")
+    DEVICE_EVENTS = worker_context.Queue()
+
+    # The friendly name of each device, and its task description for each status, are worked out once up front
+    friendly_names = [os.path.basename(device) for device in selected_devices]
+    task_descriptions = [
+        {
+            status: f"[cyan]{friendly_name} {description}"
+            for status, description in STATUS_DESCRIPTIONS.items()
+        }
+        for friendly_name in friendly_names
+    ]
+
+    TASK_LIST = [
+        progress.add_task(f"[cyan]{friendly_name} writing...", total=100)
+        for friendly_name in friendly_names
+    ]
 
     # Launch the background drive read/verify tasks
-    with Pool(processes=len(DEVICE_LIST)) as pool:
-        pool.imap(test_disk, DEVICE_LIST)
-
-        # This main process just reports the results until the tasks are finished
-        finished = False
-        with Live(layout, refresh_per_second=10, screen=False):
-            while not finished:
-                time.sleep(0.1)
-
-                maybe_finished = True
-                for idx, task in enumerate(TASK_LIST):
-                    # Determine the friendly name for the current task's device
-                    device = DEVICE_LIST[idx]
-                    friendly_name = str(device).split("/")[-1:][0]
-
-                    # Update the task name in the rich progress output
-                    if DEVICE_STATUS[idx] == 1:
-                        progress.update(
-                            task_id=task,
-                            description=f"[cyan]{friendly_name} writing 'aa'",
-                        )
-                    elif DEVICE_STATUS[idx] == 2:
-                        progress.update(
-                            task_id=task,
-                            description=f"[cyan]{friendly_name} verifying 'aa'",
-                        )
-                    elif DEVICE_STATUS[idx] == 3:
-                        progress.update(
-                            task_id=task,
-                            description=f"[cyan]{friendly_name} writing '55'",
-                        )
-                    elif DEVICE_STATUS[idx] == 4:
-                        progress.update(
-                            task_id=task,
-                            description=f"[cyan]{friendly_name} verifying '55'",
-                        )
-                    elif DEVICE_STATUS[idx] == 5:
-                        progress.update(
-                            task_id=task,
-                            description=f"[cyan]{friendly_name} writing 'ff'",
-                        )
-                    elif DEVICE_STATUS[idx] == 6:
-                        progress.update(
-                            task_id=task,
-                            description=f"[cyan]{friendly_name} verifying 'ff'",
-                        )
-                    elif DEVICE_STATUS[idx] == 7:
-                        progress.update(
-                            task_id=task,
-                            description=f"[cyan]{friendly_name} writing '00'",
-                        )
-                    elif DEVICE_STATUS[idx] == 8:
-                        progress.update(
-                            task_id=task,
-                            description=f"[cyan]{friendly_name} verifying '00'",
-                        )
-                    elif DEVICE_STATUS[idx] == 20:
-                        progress.update(
-                            task_id=task,
-                            description=f"[cyan]{friendly_name} verification failed",
-                        )
-                    elif DEVICE_STATUS[idx] == 30:
-                        progress.update(
-                            task_id=task,
-                            description=f"[cyan]{friendly_name} completed successfully",
-                        )
-                    else:
-                        progress.update(
-                            task_id=task, description=f"[cyan]{friendly_name} unknown?"
-                        )
+    # Each device gets its own long running worker process
+    workers = [
+        worker_context.Process(target=test_disk, args=(task,))
+        for task in enumerate(selected_devices)
+    ]
+    for worker in workers:
+        worker.start()
+
+    # This main process just reports the results until the tasks are finished
+    finished = False
+    finished_devices = set()
+    last_status = [None] * num_drives
+    last_progress = [None] * num_drives
+    # The progress bars only move once per percent, so a few redraws a second is plenty
+    with Live(layout, refresh_per_second=4, screen=False):
+        while not finished:
+            # Wait for a worker to report a change, then collect any others already waiting
+            changed_devices = set()
+            try:
+                changed_devices.add(DEVICE_EVENTS.get(timeout=0.1))
+                while True:
+                    changed_devices.add(DEVICE_EVENTS.get_nowait())
+            except queue.Empty:
+                pass
+
+            # Take a copy of the shared state once for all of the changed devices.  The status is copied first as
+            # the workers change it after resetting the progress
+            statuses = DEVICE_STATUS.tolist()
+            progresses = DEVICE_PROGRESS.tolist()
+            for idx in changed_devices:
+                # Only update the rich progress output for what's actually changed.  Live redraws it on its
+                # next refresh
+                status = statuses[idx]
+                completed = progresses[idx] if status < 20 else 100
+                if status >= 20:
+                    finished_devices.add(idx)
+                if status == last_status[idx] and completed == last_progress[idx]:
+                    continue
+                last_status[idx] = status
+                last_progress[idx] = completed
+
+                # Update the task name and progress
+                description = task_descriptions[idx].get(
+                    status, f"[cyan]{friendly_names[idx]} unknown?"
+                )
+                progress.update(
+                    task_id=TASK_LIST[idx],
+                    description=description,
+                    completed=completed,
+                )
 
-                    # Determine if any tasks are still progressing
-                    # TODO: The individual tasks have a boolean "finished" attribute which seems like it should be
-                    #       better for this
-                    if DEVICE_STATUS[idx] < 20:
-                        maybe_finished = False
-                        progress.update(
-                            task_id=task, completed=DEVICE_PROGRESS[idx], refresh=True
-                        )
-                    else:
-                        progress.update(task_id=task, completed=100, refresh=True)
+            # Determine if any tasks are still progressing.  This goes by the reported changes rather than
+            # DEVICE_STATUS directly, so the final change for each device is always displayed.  Workers that
+            # gave up early never report a final status, so also stop once they've all exited and gone quiet
+            # TODO: The individual tasks have a boolean "finished" attribute which seems like it should be
+            #       better for this
+            finished = len(finished_devices) == num_drives or (
+                not any(worker.is_alive() for worker in workers) and not changed_devices
+            )
+
+    # Wait for the workers to exit.  Anything that went wrong in them has already been printed by them
+    for worker in workers:
+        worker.join()
 
-                if maybe_finished is True:
-                    finished = True
+    # Clean up the shared memory
+    DEVICE_PROGRESS.release()
+    DEVICE_STATUS.release()
+    DEVICE_SHM.close()
+    DEVICE_SHM.unlink()
 
     # TODO: Record useful results to disk
 